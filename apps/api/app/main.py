@@ -1,96 +1,163 @@
 import os
 import json
 import time
+from datetime import datetime
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 
-import psycopg2
+import asyncpg
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
+from ulid import ULID
+
+from .migrate import SCHEMA_VERSION, schema_current
 
 app = FastAPI(title="ClimSystems AI Agent API", version="0.1.0")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# "host:port" of a PgBouncer in transaction mode. When set, pooled
+# connections go through it using DATABASE_URL's credentials and dbname.
+PGBOUNCER_HOSTPORT = os.getenv("PGBOUNCER_HOSTPORT")
+
+# Rows per multi-VALUES INSERT in bulk_upsert. At 400 the statement stays
+# under asyncpg's default max_cacheable_statement_size (15360 bytes), so
+# full pages are prepared once per connection rather than on every call.
+UPSERT_PAGE_SIZE = 400
+# At or above this many assets, bulk_upsert loads through COPY instead.
+COPY_THRESHOLD = 1024
+# Items per page of the tenant-wide evidence listing.
+EVIDENCE_PAGE_SIZE = 50
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+
+POOL: Optional[asyncpg.Pool] = None
+
+# get_run responses. Finished runs are kept until evicted or invalidated by a
+# runs_changed notification; others only briefly, to absorb tight polling.
+_TERMINAL_STATUSES = ("done", "failed")
+_RUN_CACHE_TERMINAL: LRUCache = LRUCache(maxsize=10_000)
+_RUN_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=0.2)
+# Invalidation counters, so a get_run whose query raced a notification doesn't
+# cache the row it read before the change: per run, plus one bumped when the
+# listener is lost (or the per-run ones are reset).
+_RUN_CACHE_GENS: Dict[tuple, int] = {}
+_RUN_CACHE_GENS_MAX = 10_000
+_RUN_CACHE_EPOCH = 0
+# list_evidence's first tenant-wide page, per tenant.
+_EVIDENCE_LATEST_CACHE: TTLCache = TTLCache(maxsize=1_000, ttl=1.0)
+
+_RUN_LISTENER: Optional[asyncpg.Connection] = None
+_RUN_LISTENER_RETRY_AT = 0.0
+_RUN_LISTENER_RETRY_SECONDS = 5.0
+
+
+def _conn_params() -> dict:
+    params = {"dsn": DATABASE_URL}
+    if PGBOUNCER_HOSTPORT:
+        host, _, port = PGBOUNCER_HOSTPORT.rpartition(":")
+        params.update(host=host, port=int(port))
+    return params
+
+
+async def _init_conn(conn: asyncpg.Connection):
+    # Exchange JSONB as Python objects, like psycopg2 did. Binary format so
+    # the codec also works for copy_records_to_table; byte 0 is the version.
+    await conn.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=lambda v: b"\x01" + json.dumps(v).encode(),
+        decoder=lambda b: json.loads(b[1:]),
+        format="binary",
+    )
+
+
+async def _init_pool():
+    global POOL
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    POOL = await asyncpg.create_pool(
+        min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, init=_init_conn, **_conn_params()
+    )
 
 
 def _db():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    return psycopg2.connect(DATABASE_URL)
-
-
-def _init_db():
-    """Create minimal tables if they don't exist (starter-friendly)."""
-    ddl = """
-    CREATE TABLE IF NOT EXISTS assets (
-      tenant_id TEXT NOT NULL DEFAULT 'default',
-      external_id TEXT NOT NULL,
-      name TEXT,
-      lat DOUBLE PRECISION,
-      lon DOUBLE PRECISION,
-      meta JSONB NOT NULL DEFAULT '{}'::jsonb,
-      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-      updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-      PRIMARY KEY (tenant_id, external_id)
-    );
-
-    CREATE TABLE IF NOT EXISTS analysis_runs (
-      run_id TEXT PRIMARY KEY,
-      tenant_id TEXT NOT NULL DEFAULT 'default',
-      status TEXT NOT NULL,
-      parameters JSONB NOT NULL DEFAULT '{}'::jsonb,
-      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-      updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-      error TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS jobs (
-      job_id TEXT PRIMARY KEY,
-      tenant_id TEXT NOT NULL DEFAULT 'default',
-      run_id TEXT,
-      type TEXT NOT NULL,
-      status TEXT NOT NULL,
-      payload JSONB NOT NULL DEFAULT '{}'::jsonb,
-      attempts INT NOT NULL DEFAULT 0,
-      max_attempts INT NOT NULL DEFAULT 3,
-      run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
-      locked_by TEXT,
-      locked_at TIMESTAMPTZ,
-      last_error TEXT,
-      created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-      updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
-    );
-
-    CREATE TABLE IF NOT EXISTS evidence_items (
-      evidence_id TEXT PRIMARY KEY,
-      tenant_id TEXT NOT NULL DEFAULT 'default',
-      run_id TEXT,
-      type TEXT NOT NULL,
-      content JSONB NOT NULL DEFAULT '{}'::jsonb,
-      created_at TIMESTAMPTZ NOT NULL DEFAULT now()
-    );
-    """
-    with _db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(ddl)
-        conn.commit()
+    """Acquire a pooled connection: `async with _db() as conn:`."""
+    if POOL is None:
+        raise RuntimeError("connection pool is not initialised")
+    return POOL.acquire()
+
+
+def _on_run_changed(conn, pid, channel, payload):
+    global _RUN_CACHE_EPOCH
+    msg = json.loads(payload)
+    key = (msg["tenant_id"], msg["run_id"])
+    if key not in _RUN_CACHE_GENS and len(_RUN_CACHE_GENS) >= _RUN_CACHE_GENS_MAX:
+        _RUN_CACHE_GENS.clear()
+        _RUN_CACHE_EPOCH += 1
+    _RUN_CACHE_GENS[key] = _RUN_CACHE_GENS.get(key, 0) + 1
+    _RUN_CACHE.pop(key, None)
+    _RUN_CACHE_TERMINAL.pop(key, None)
+
+
+def _on_listener_lost(conn):
+    global _RUN_LISTENER, _RUN_CACHE_EPOCH
+    # Missed notifications could leave stale entries behind.
+    _RUN_LISTENER = None
+    _RUN_CACHE_EPOCH += 1
+    _RUN_CACHE_GENS.clear()
+    _RUN_CACHE.clear()
+    _RUN_CACHE_TERMINAL.clear()
+
+
+async def _ensure_run_listener() -> bool:
+    """Keep a LISTEN runs_changed connection open; get_run caches only while it is."""
+    global _RUN_LISTENER, _RUN_LISTENER_RETRY_AT
+    if _RUN_LISTENER is not None and not _RUN_LISTENER.is_closed():
+        return True
+    if time.monotonic() < _RUN_LISTENER_RETRY_AT:
+        return False
+    _RUN_LISTENER_RETRY_AT = time.monotonic() + _RUN_LISTENER_RETRY_SECONDS
+    try:
+        # LISTEN is session state, so this bypasses the pool (and PgBouncer).
+        conn = await asyncpg.connect(DATABASE_URL)
+        await conn.add_listener("runs_changed", _on_run_changed)
+        conn.add_termination_listener(_on_listener_lost)
+    except Exception as e:
+        print(f"runs_changed listener unavailable: {e!r}")
+        return False
+    _RUN_LISTENER = conn
+    return True
 
 
 @app.on_event("startup")
-def on_startup():
-    _init_db()
+async def on_startup():
+    # Schema changes run out of band (`python -m app.migrate`) so replicas
+    # start without waiting on, or contending for, catalog locks.
+    await _init_pool()
+    await _ensure_run_listener()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _RUN_LISTENER is not None:
+        await _RUN_LISTENER.close()
+    if POOL is not None:
+        await POOL.close()
 
 
 @app.get("/health")
-def health():
-    # Also checks DB connectivity
+async def health():
+    # Also checks DB connectivity and that migrations have run
     try:
-        with _db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1")
-                cur.fetchone()
-        return {"ok": True}
+        async with _db() as conn:
+            current = await schema_current(conn)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB not ready: {e}")
+    if not current:
+        raise HTTPException(status_code=500, detail=f"DB schema is not at version {SCHEMA_VERSION}")
+    return {"ok": True}
 
 
 class AssetIn(BaseModel):
@@ -106,29 +173,72 @@ class BulkUpsertReq(BaseModel):
     assets: List[AssetIn]
 
 
+_UPSERT_CONFLICT = """
+    ON CONFLICT (tenant_id, external_id)
+    DO UPDATE SET
+      name = EXCLUDED.name,
+      lat = EXCLUDED.lat,
+      lon = EXCLUDED.lon,
+      meta = EXCLUDED.meta,
+      updated_at = now()
+"""
+
+
+_ASSET_COLUMNS = ("tenant_id", "external_id", "name", "lat", "lon", "meta")
+
+
+@lru_cache(maxsize=32)
+def _upsert_sql(n: int) -> str:
+    """INSERT ... ON CONFLICT with a VALUES list of `n` rows.
+
+    Cached so repeat batch sizes (and every full page) reuse one string;
+    while it is under max_cacheable_statement_size, asyncpg's statement
+    cache also maps it to one prepared statement per connection.
+    """
+    width = len(_ASSET_COLUMNS)
+    values = ",".join(
+        "(" + ",".join(f"${r * width + c + 1}" for c in range(width)) + ")" for r in range(n)
+    )
+    return f"INSERT INTO assets ({', '.join(_ASSET_COLUMNS)}) VALUES {values}" + _UPSERT_CONFLICT
+
+
+async def _upsert_values(conn: asyncpg.Connection, tenant_id: str, assets: List[AssetIn]):
+    for i in range(0, len(assets), UPSERT_PAGE_SIZE):
+        page = assets[i : i + UPSERT_PAGE_SIZE]
+        args = [v for a in page for v in (tenant_id, a.external_id, a.name, a.lat, a.lon, a.meta)]
+        await conn.execute(_upsert_sql(len(page)), *args)
+
+
+async def _upsert_copy(conn: asyncpg.Connection, tenant_id: str, assets: List[AssetIn]):
+    """Stream assets into a temp table with COPY, then merge them in one statement."""
+    await conn.execute("CREATE TEMP TABLE _stage (LIKE assets INCLUDING DEFAULTS) ON COMMIT DROP")
+    await conn.copy_records_to_table(
+        "_stage",
+        records=[(tenant_id, a.external_id, a.name, a.lat, a.lon, a.meta) for a in assets],
+        columns=_ASSET_COLUMNS,
+    )
+    await conn.execute(
+        f"INSERT INTO assets ({', '.join(_ASSET_COLUMNS)}) "
+        f"SELECT {', '.join(_ASSET_COLUMNS)} FROM _stage"
+        + _UPSERT_CONFLICT
+    )
+
+
 @app.post("/v1/assets:bulk_upsert")
-def bulk_upsert(req: BulkUpsertReq):
+async def bulk_upsert(req: BulkUpsertReq):
     if not req.assets:
         return {"upserted": 0}
 
-    with _db() as conn:
-        with conn.cursor() as cur:
-            for a in req.assets:
-                cur.execute(
-                    """
-                    INSERT INTO assets (tenant_id, external_id, name, lat, lon, meta)
-                    VALUES (%s, %s, %s, %s, %s, %s::jsonb)
-                    ON CONFLICT (tenant_id, external_id)
-                    DO UPDATE SET
-                      name = EXCLUDED.name,
-                      lat = EXCLUDED.lat,
-                      lon = EXCLUDED.lon,
-                      meta = EXCLUDED.meta,
-                      updated_at = now();
-                    """,
-                    (req.tenant_id, a.external_id, a.name, a.lat, a.lon, json.dumps(a.meta)),
-                )
-        conn.commit()
+    # A single statement can't touch the same key twice under
+    # ON CONFLICT DO UPDATE, so keep the last occurrence of each asset.
+    assets = list({a.external_id: a for a in req.assets}.values())
+
+    async with _db() as conn:
+        async with conn.transaction():
+            if len(assets) >= COPY_THRESHOLD:
+                await _upsert_copy(conn, req.tenant_id, assets)
+            else:
+                await _upsert_values(conn, req.tenant_id, assets)
 
     return {"upserted": len(req.assets)}
 
@@ -140,71 +250,143 @@ class CreateRunReq(BaseModel):
 
 
 @app.post("/v1/runs")
-def create_run(req: CreateRunReq):
-    run_id = f"run_{int(time.time()*1000)}"
-    job_id = f"job_{int(time.time()*1000)}"
-
-    with _db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO analysis_runs (run_id, tenant_id, status, parameters) VALUES (%s,%s,%s,%s::jsonb)",
-                (run_id, req.tenant_id, "queued", json.dumps({"name": req.name, **req.parameters})),
+async def create_run(req: CreateRunReq):
+    # ULIDs sort by creation time, keeping primary-key inserts at the index tail,
+    # and can't collide the way two millisecond timestamps could.
+    run_id = f"run_{ULID()}"
+    job_id = f"job_{ULID()}"
+
+    # Run, job and worker wake-up in one statement: one round-trip, one commit.
+    # The NOTIFY is delivered when the statement's implicit transaction commits.
+    async with _db() as conn:
+        await conn.execute(
+            """
+            WITH r AS (
+              INSERT INTO analysis_runs (run_id, tenant_id, status, parameters)
+              VALUES ($1, $2, 'queued', $3)
+            ),
+            j AS (
+              INSERT INTO jobs (job_id, tenant_id, run_id, type, status, payload)
+              VALUES ($4, $2, $1, 'RUN_ANALYSIS', 'queued', $5)
+              RETURNING job_id
             )
-            cur.execute(
-                """
-                INSERT INTO jobs (job_id, tenant_id, run_id, type, status, payload)
-                VALUES (%s, %s, %s, %s, %s, %s::jsonb)
-                """,
-                (job_id, req.tenant_id, run_id, "RUN_ANALYSIS", "queued", json.dumps({"demo": True})),
-            )
-        conn.commit()
+            SELECT pg_notify('jobs_new', '') FROM j
+            """,
+            run_id, req.tenant_id, {"name": req.name, **req.parameters}, job_id, {"demo": True},
+        )
 
     return {"run_id": run_id, "status": "queued"}
 
 
+def _iso_utc(column: str) -> str:
+    """Select a timestamptz as an ISO 8601 UTC string, formatted by Postgres."""
+    return f"""to_char({column} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') AS {column}_iso"""
+
+
+_GET_RUN_SQL = (
+    f"SELECT run_id, status, parameters, {_iso_utc('created_at')}, {_iso_utc('updated_at')}, error "
+    "FROM analysis_runs WHERE tenant_id=$1 AND run_id=$2"
+)
+_EVIDENCE_BY_RUN_SQL = (
+    f"SELECT evidence_id, type, {_iso_utc('created_at')}, content FROM evidence_items "
+    "WHERE tenant_id=$1 AND run_id=$2 ORDER BY created_at DESC"
+)
+_EVIDENCE_LATEST_SQL = (
+    f"SELECT evidence_id, type, {_iso_utc('created_at')}, content FROM evidence_items "
+    "WHERE tenant_id=$1 ORDER BY created_at DESC, evidence_id DESC LIMIT $2"
+)
+_EVIDENCE_BEFORE_SQL = (
+    f"SELECT evidence_id, type, {_iso_utc('created_at')}, content FROM evidence_items "
+    "WHERE tenant_id=$1 AND (created_at, evidence_id) < ($2, $3) "
+    "ORDER BY created_at DESC, evidence_id DESC LIMIT $4"
+)
+
+
 @app.get("/v1/runs/{run_id}")
-def get_run(run_id: str, tenant_id: str = "default"):
-    with _db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT run_id, status, parameters, created_at, updated_at, error FROM analysis_runs WHERE tenant_id=%s AND run_id=%s",
-                (tenant_id, run_id),
-            )
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail="run not found")
-            return {
-                "run_id": row[0],
-                "status": row[1],
-                "parameters": row[2],
-                "created_at": row[3].isoformat(),
-                "updated_at": row[4].isoformat(),
-                "error": row[5],
-            }
+async def get_run(run_id: str, tenant_id: str = "default"):
+    key = (tenant_id, run_id)
+    # Without the listener, a failed run being retried could be served stale.
+    use_cache = await _ensure_run_listener()
+    if use_cache:
+        cached = _RUN_CACHE_TERMINAL.get(key) or _RUN_CACHE.get(key)
+        if cached is not None:
+            return cached
+
+    gen = (_RUN_CACHE_EPOCH, _RUN_CACHE_GENS.get(key, 0))
+    async with _db() as conn:
+        row = await conn.fetchrow(_GET_RUN_SQL, tenant_id, run_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="run not found")
+    run = {
+        "run_id": row[0],
+        "status": row[1],
+        "parameters": row[2],
+        "created_at": row[3],
+        "updated_at": row[4],
+        "error": row[5],
+    }
+    if use_cache and gen == (_RUN_CACHE_EPOCH, _RUN_CACHE_GENS.get(key, 0)):
+        _RUN_CACHE[key] = run
+        if run["status"] in _TERMINAL_STATUSES:
+            _RUN_CACHE_TERMINAL[key] = run
+    return run
+
+
+def _evidence_cursor(item: dict) -> str:
+    # created_at is microsecond-precise UTC, so it round-trips exactly.
+    return f"{item['created_at']}|{item['evidence_id']}"
+
+
+def _parse_evidence_cursor(cursor: str):
+    created_at, sep, evidence_id = cursor.partition("|")
+    try:
+        if not sep:
+            raise ValueError(cursor)
+        return datetime.fromisoformat(created_at.replace("Z", "+00:00")), evidence_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor")
 
 
 @app.get("/v1/evidence")
-def list_evidence(run_id: Optional[str] = None, tenant_id: str = "default"):
-    with _db() as conn:
-        with conn.cursor() as cur:
-            if run_id:
-                cur.execute(
-                    "SELECT evidence_id, type, created_at, content FROM evidence_items WHERE tenant_id=%s AND run_id=%s ORDER BY created_at DESC",
-                    (tenant_id, run_id),
-                )
-            else:
-                cur.execute(
-                    "SELECT evidence_id, type, created_at, content FROM evidence_items WHERE tenant_id=%s ORDER BY created_at DESC LIMIT 50",
-                    (tenant_id,),
-                )
-            rows = cur.fetchall()
+async def list_evidence(
+    run_id: Optional[str] = None, tenant_id: str = "default", before: Optional[str] = None
+):
+    """Evidence for a run (a list), or the tenant's latest evidence a page at a time.
+
+    Without run_id, pass the returned next_cursor as `before` for the next page.
+    """
+    first_page = not run_id and not before
+    if first_page:
+        cached = _EVIDENCE_LATEST_CACHE.get(tenant_id)
+        if cached is not None:
+            return cached
+
+    async with _db() as conn:
+        if run_id:
+            rows = await conn.fetch(_EVIDENCE_BY_RUN_SQL, tenant_id, run_id)
+        elif before:
+            created_at, evidence_id = _parse_evidence_cursor(before)
+            rows = await conn.fetch(
+                _EVIDENCE_BEFORE_SQL, tenant_id, created_at, evidence_id, EVIDENCE_PAGE_SIZE
+            )
+        else:
+            rows = await conn.fetch(_EVIDENCE_LATEST_SQL, tenant_id, EVIDENCE_PAGE_SIZE)
 
-    return [
+    items = [
         {
             "evidence_id": r[0],
             "type": r[1],
-            "created_at": r[2].isoformat(),
+            "created_at": r[2],
             "content": r[3],
         }
         for r in rows
     ]
+    if run_id:
+        return items
+    next_cursor = None
+    if len(items) == EVIDENCE_PAGE_SIZE:
+        next_cursor = _evidence_cursor(items[-1])
+    evidence = {"items": items, "next_cursor": next_cursor}
+    if first_page:
+        _EVIDENCE_LATEST_CACHE[tenant_id] = evidence
+    return evidence
@@ -0,0 +1,128 @@
+"""Create or upgrade the database schema.
+
+Run once per deploy, before the API starts: `python -m app.migrate`.
+"""
+import os
+import asyncio
+
+import asyncpg
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Bump when DDL changes; the API's health check fails until it is applied.
+SCHEMA_VERSION = 4
+_MIGRATION_LOCK_ID = 4242001
+
+DDL = """
+CREATE TABLE IF NOT EXISTS assets (
+  tenant_id TEXT NOT NULL DEFAULT 'default',
+  external_id TEXT NOT NULL,
+  name TEXT,
+  lat DOUBLE PRECISION,
+  lon DOUBLE PRECISION,
+  meta JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (tenant_id, external_id)
+);
+
+CREATE TABLE IF NOT EXISTS analysis_runs (
+  run_id TEXT PRIMARY KEY,
+  tenant_id TEXT NOT NULL DEFAULT 'default',
+  status TEXT NOT NULL,
+  parameters JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  error TEXT
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id TEXT PRIMARY KEY,
+  tenant_id TEXT NOT NULL DEFAULT 'default',
+  run_id TEXT,
+  type TEXT NOT NULL,
+  status TEXT NOT NULL,
+  payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+  attempts INT NOT NULL DEFAULT 0,
+  max_attempts INT NOT NULL DEFAULT 3,
+  run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_by TEXT,
+  locked_at TIMESTAMPTZ,
+  last_error TEXT,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Only claimable rows are indexed, so the worker's claim scan stays small.
+CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs (run_after, created_at) WHERE status='queued';
+
+CREATE TABLE IF NOT EXISTS evidence_items (
+  evidence_id TEXT PRIMARY KEY,
+  tenant_id TEXT NOT NULL DEFAULT 'default',
+  run_id TEXT,
+  type TEXT NOT NULL,
+  content JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Serves the per-tenant latest-evidence listing and its keyset pages.
+CREATE INDEX IF NOT EXISTS idx_evidence_tenant_time
+  ON evidence_items (tenant_id, created_at DESC, evidence_id DESC);
+
+-- Lets API processes drop cached get_run responses when a finished run changes
+-- (a failed run being retried). Other cached responses expire on their own, and
+-- a pending NOTIFY serialises commits, so the worker's hot path sends none.
+CREATE OR REPLACE FUNCTION notify_run_changed() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify(
+    'runs_changed',
+    json_build_object('tenant_id', NEW.tenant_id, 'run_id', NEW.run_id)::text
+  );
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analysis_runs_notify ON analysis_runs;
+CREATE TRIGGER analysis_runs_notify
+  AFTER UPDATE ON analysis_runs
+  FOR EACH ROW WHEN (OLD.status IN ('done', 'failed'))
+  EXECUTE FUNCTION notify_run_changed();
+
+CREATE TABLE IF NOT EXISTS schema_meta (
+  version INT PRIMARY KEY
+);
+"""
+
+
+async def schema_current(conn: asyncpg.Connection) -> bool:
+    try:
+        return await conn.fetchval("SELECT 1 FROM schema_meta WHERE version=$1", SCHEMA_VERSION) is not None
+    except asyncpg.UndefinedTableError:
+        return False
+
+
+async def migrate():
+    """Apply DDL unless schema_meta already records SCHEMA_VERSION."""
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if await schema_current(conn):
+            print(f"Schema already at version {SCHEMA_VERSION}")
+            return
+        async with conn.transaction():
+            # Serialise concurrent runs; the DDL is idempotent, so whoever
+            # waits just re-runs it. The lock ends with the transaction.
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+            await conn.execute(DDL)
+            await conn.execute(
+                "INSERT INTO schema_meta (version) VALUES ($1) ON CONFLICT DO NOTHING",
+                SCHEMA_VERSION,
+            )
+        print(f"Schema migrated to version {SCHEMA_VERSION}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -1,98 +1,295 @@
 import os
-import json
 import time
+import select
 import socket
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from ulid import ULID
 
+# The worker connects straight to Postgres, not through PgBouncer: its
+# statements are PREPAREd per session, which transaction pooling would break.
 DATABASE_URL = os.getenv("DATABASE_URL")
 WORKER_ID = socket.gethostname()
+# Jobs processed at once. Analysis jobs mostly wait on external APIs, so
+# threads scale throughput until the database or those APIs push back.
+CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+# Most jobs claimed per round-trip. Only free slots are claimed for, so this
+# is capped at CONCURRENCY; raise both together for short jobs.
+BATCH_SIZE = min(int(os.getenv("WORKER_BATCH_SIZE", "4")), CONCURRENCY)
+# Longest a busy worker holds off claiming while it waits for BATCH_SIZE
+# slots to free up, instead of claiming one job per round-trip.
+BATCH_WAIT = float(os.getenv("WORKER_BATCH_WAIT", "0.1"))
+# Longest an idle worker sleeps without a jobs_new notification. This also
+# bounds how late a retry whose backoff has expired gets picked up.
+IDLE_TIMEOUT = float(os.getenv("WORKER_IDLE_TIMEOUT", "30"))
+# Upper bound, in UTF-8 bytes, for error text stored on jobs and runs.
+MAX_ERROR_BYTES = 2000
 
+# "postgres" or "cockroach"; detected from version() when unset.
+DB_FLAVOR = os.getenv("DB_FLAVOR")
+# How often to poll for jobs where LISTEN/NOTIFY isn't available (CockroachDB).
+POLL_INTERVAL = 1.0
+# Immediate re-claims after losing a claim race before treating the queue as empty.
+CLAIM_RETRIES = 3
 
-def _db():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    return psycopg2.connect(DATABASE_URL)
+POOL: ThreadedConnectionPool | None = None
+_POOL_LOCK = threading.Lock()
+_PREPARE: tuple[str, ...] = ()
+_LISTEN_CONN = None
 
 
-def claim_job():
-    q = """
+# claim_jobs, completed with the flavor's `pick` query from _CLAIM_PICK.
+_CLAIM_SQL = """
+    PREPARE claim_jobs(int, text) AS
     WITH cte AS (
-      SELECT job_id
+      {pick}
+    ),
+    claimed AS (
+      UPDATE jobs
+      SET status='running', locked_by=$2, locked_at=now(), updated_at=now()
+      WHERE job_id IN (SELECT job_id FROM cte) AND status='queued'
+      RETURNING job_id, tenant_id, run_id, type, payload, attempts, max_attempts
+    ),
+    runs AS (
+      UPDATE analysis_runs r
+      SET status='running', updated_at=now()
+      FROM claimed c
+      WHERE r.tenant_id = c.tenant_id AND r.run_id = c.run_id
+    )
+    SELECT job_id, tenant_id, run_id, type, payload, attempts, max_attempts FROM claimed
+"""
+# How claim_jobs picks due jobs, per DB_FLAVOR. Postgres skips rows other
+# workers have locked. CockroachDB's SKIP LOCKED can pass over unlocked rows
+# and degrades under contention, so there the UPDATE's own write decides the
+# race and a worker that loses it gets a retry error and claims again.
+_CLAIM_PICK = {
+    "postgres": """SELECT job_id
       FROM jobs
       WHERE status='queued'
         AND run_after <= now()
       ORDER BY created_at
       FOR UPDATE SKIP LOCKED
-      LIMIT 1
+      LIMIT $1""",
+    "cockroach": """SELECT job_id
+      FROM jobs
+      WHERE status='queued'
+        AND run_after <= now()
+      ORDER BY created_at
+      LIMIT $1""",
+}
+
+# Hot statements, parsed and planned once per connection and run via EXECUTE.
+# claim_jobs is prepended once the flavor is known; see _init_pool.
+_PREPARED_STATEMENTS = (
+    """
+    PREPARE mark_run_status(text, text, text, text) AS
+    UPDATE analysis_runs SET status=$1, updated_at=now(), error=$2 WHERE tenant_id=$3 AND run_id=$4
+    """,
+    """
+    PREPARE complete_job(text, text, text) AS
+    WITH r AS (
+      UPDATE analysis_runs
+      SET status='done', updated_at=now(), error=NULL
+      WHERE tenant_id=$1 AND run_id=$2
     )
-    UPDATE jobs
-    SET status='running', locked_by=%s, locked_at=now(), updated_at=now()
-    WHERE job_id IN (SELECT job_id FROM cte)
-    RETURNING job_id, tenant_id, run_id, type, payload, attempts, max_attempts;
+    UPDATE jobs SET status='done', updated_at=now() WHERE job_id=$3
+    """,
     """
-    with _db() as conn:
+    PREPARE mark_job_failed(text, int, text, int, text) AS
+    UPDATE jobs
+    SET status=$1,
+        attempts=$2,
+        last_error=$3,
+        locked_by=NULL,
+        locked_at=NULL,
+        run_after=CASE WHEN $1='queued' THEN now() + $4 * interval '1 second' ELSE now() END,
+        updated_at=now()
+    WHERE job_id=$5
+    """,
+)
+
+
+class _PreparedConnection(psycopg2.extensions.connection):
+    prepared = False
+
+
+def _detect_flavor(conn) -> str:
+    with conn.cursor() as cur:
+        cur.execute("SELECT version()")
+        version = cur.fetchone()[0]
+    conn.rollback()
+    return "cockroach" if "CockroachDB" in version else "postgres"
+
+
+def _init_pool():
+    global POOL, DB_FLAVOR, _PREPARE
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    # One connection per job thread plus one for claiming. psycopg2 closes
+    # anything above minconn on return, which would also drop the prepared
+    # statements, so keep them all open.
+    size = CONCURRENCY + 1
+    pool = ThreadedConnectionPool(
+        minconn=size, maxconn=size, dsn=DATABASE_URL, connection_factory=_PreparedConnection
+    )
+    try:
+        if not DB_FLAVOR:
+            conn = pool.getconn()
+            try:
+                DB_FLAVOR = _detect_flavor(conn)
+            finally:
+                pool.putconn(conn)
+        if DB_FLAVOR not in _CLAIM_PICK:
+            raise RuntimeError(f"unsupported DB_FLAVOR {DB_FLAVOR!r}")
+    except Exception:
+        pool.closeall()
+        raise
+    print(f"Database flavor: {DB_FLAVOR}")
+    _PREPARE = (_CLAIM_SQL.format(pick=_CLAIM_PICK[DB_FLAVOR]),) + _PREPARED_STATEMENTS
+    POOL = pool
+
+
+def _ensure_pool():
+    if POOL is None:
+        # Created lazily so a database that is down at boot is retried by the
+        # main loop rather than crashing the worker.
+        with _POOL_LOCK:
+            if POOL is None:
+                _init_pool()
+
+
+@contextmanager
+def _db():
+    """Borrow a pooled connection; uncommitted work is rolled back on return."""
+    _ensure_pool()
+    conn = POOL.getconn()
+    broken = False
+    try:
+        if not conn.prepared:
+            try:
+                with conn.cursor() as cur:
+                    for stmt in _PREPARE:
+                        cur.execute(stmt)
+                conn.commit()
+            except Exception:
+                # PREPARE isn't undone by rollback; start over on a fresh session.
+                broken = True
+                raise
+            conn.prepared = True
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # Server went away or the socket died; reconnect on the next checkout.
+        broken = True
+        raise
+    finally:
+        POOL.putconn(conn, close=broken)
+
+
+def _listener():
+    """Long-lived autocommit connection subscribed to jobs_new (None on CockroachDB)."""
+    global _LISTEN_CONN
+    _ensure_pool()
+    if DB_FLAVOR == "cockroach":
+        return None
+    if _LISTEN_CONN is None or _LISTEN_CONN.closed:
+        # Waiting on notifications ties up a session indefinitely, so this is
+        # its own connection rather than one of the job pool's.
+        conn = psycopg2.connect(DATABASE_URL)
+        conn.autocommit = True
         with conn.cursor() as cur:
-            cur.execute(q, (WORKER_ID,))
-            row = cur.fetchone()
-        conn.commit()
-    return row
+            cur.execute("LISTEN jobs_new")
+        _LISTEN_CONN = conn
+    return _LISTEN_CONN
+
+
+def wait_for_jobs(timeout: float):
+    conn = _listener()
+    if conn is None:
+        time.sleep(min(timeout, POLL_INTERVAL))
+        return
+    try:
+        if select.select([conn], [], [], timeout)[0]:
+            conn.poll()
+            conn.notifies.clear()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        conn.close()
+        raise
+
+
+def claim_jobs(limit: int):
+    """Claim up to `limit` due jobs and flip their runs to 'running' in the same statement."""
+    for _ in range(CLAIM_RETRIES):
+        try:
+            with _db() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("EXECUTE claim_jobs(%s, %s)", (limit, WORKER_ID))
+                    rows = cur.fetchall()
+                conn.commit()
+            return rows
+        except psycopg2.errors.SerializationFailure:
+            # Another worker won the race for these rows (CockroachDB's
+            # claim path); pick again from what is left.
+            continue
+    return []
 
 
 def mark_run_status(tenant_id: str, run_id: str, status: str, error: str | None = None):
     with _db() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "UPDATE analysis_runs SET status=%s, updated_at=now(), error=%s WHERE tenant_id=%s AND run_id=%s",
+                "EXECUTE mark_run_status(%s, %s, %s, %s)",
                 (status, error, tenant_id, run_id),
             )
         conn.commit()
 
 
-def add_evidence(tenant_id: str, run_id: str, evidence_id: str, ev_type: str, content: dict):
-    with _db() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO evidence_items (evidence_id, tenant_id, run_id, type, content) VALUES (%s,%s,%s,%s,%s::jsonb)",
-                (evidence_id, tenant_id, run_id, ev_type, json.dumps(content)),
-            )
-        conn.commit()
+def add_evidence_bulk(cur, tenant_id: str, run_id: str, items: list[tuple[str, str, dict]]):
+    """Insert (evidence_id, type, content) items in one multi-row statement."""
+    if not items:
+        return
+    execute_values(
+        cur,
+        "INSERT INTO evidence_items (evidence_id, tenant_id, run_id, type, content) VALUES %s",
+        [(ev_id, tenant_id, run_id, ev_type, Json(content)) for ev_id, ev_type, content in items],
+    )
 
 
-def mark_job_done(job_id: str):
-    with _db() as conn:
-        with conn.cursor() as cur:
-            cur.execute("UPDATE jobs SET status='done', updated_at=now() WHERE job_id=%s", (job_id,))
-        conn.commit()
+def complete_job(cur, job_id: str, tenant_id: str, run_id: str | None):
+    """Mark the run and the job done in one statement."""
+    cur.execute("EXECUTE complete_job(%s, %s, %s)", (tenant_id, run_id, job_id))
+
+
+def _error_text(e: Exception) -> str:
+    """`Type: message`, cut to MAX_ERROR_BYTES without splitting a character."""
+    err = f"{type(e).__name__}: {e}"
+    return err.encode("utf-8")[:MAX_ERROR_BYTES].decode("utf-8", "ignore")
 
 
 def mark_job_failed(job_id: str, attempts: int, max_attempts: int, err: str):
     backoff = [5, 20, 60]
     delay = backoff[min(attempts, len(backoff)-1)]
     status = 'queued' if attempts + 1 < max_attempts else 'failed'
-    run_after_expr = f"now() + interval '{delay} seconds'" if status == 'queued' else 'now()'
 
     with _db() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                f"""
-                UPDATE jobs
-                SET status=%s,
-                    attempts=%s,
-                    last_error=%s,
-                    locked_by=NULL,
-                    locked_at=NULL,
-                    run_after={run_after_expr},
-                    updated_at=now()
-                WHERE job_id=%s
-                """,
-                (status, attempts + 1, err[:2000], job_id),
+                "EXECUTE mark_job_failed(%s, %s, %s, %s, %s)",
+                (status, attempts + 1, err, delay, job_id),
             )
         conn.commit()
 
 
-def run_demo_analysis(tenant_id: str, run_id: str):
+def run_demo_analysis(tenant_id: str, run_id: str) -> list[tuple[str, str, dict]]:
+    """Return evidence items as (evidence_id, type, content); the caller stores them."""
     # Demo: create a tiny evidence payload (replace with real ClimSystems API calls)
-    ev_id = f"evi_demo_{int(time.time()*1000)}"
+    ev_id = f"evi_demo_{ULID()}"
     content = {
         "dataset_version": "demo_v1",
         "scenario": ["ssp245", "ssp585"],
@@ -100,42 +297,76 @@ def run_demo_analysis(tenant_id: str, run_id: str):
         "percentile": 50,
         "note": "Demo evidence produced by worker. Replace with ClimSystems API results.",
     }
-    add_evidence(tenant_id, run_id, ev_id, "generated", content)
+    return [(ev_id, "generated", content)]
+
+
+def process_job(job):
+    job_id, tenant_id, run_id, jtype, payload, attempts, max_attempts = job
+    print(f"Claimed job {job_id} type={jtype} run_id={run_id}")
+    try:
+        # Analysis runs before borrowing a connection, so slow external calls
+        # don't hold one open.
+        evidence = run_demo_analysis(tenant_id, run_id) if jtype == 'RUN_ANALYSIS' else []
+        # Evidence and the terminal status updates share one transaction,
+        # so a job either finishes completely or leaves nothing behind.
+        with _db() as conn:
+            with conn.cursor() as cur:
+                add_evidence_bulk(cur, tenant_id, run_id, evidence)
+                complete_job(cur, job_id, tenant_id, run_id)
+            conn.commit()
+    except Exception as e:
+        err = _error_text(e)
+        print(f"Job error: {err}")
+        if run_id:
+            mark_run_status(tenant_id, run_id, 'failed', error=err)
+        mark_job_failed(job_id, attempts, max_attempts, err)
+
+
+def _reap(in_flight: set[Future]) -> set[Future]:
+    """Drop finished jobs from `in_flight`, reporting any that crashed."""
+    done = {f for f in in_flight if f.done()}
+    for f in done:
+        if f.exception() is not None:
+            print(f"Worker error: {f.exception()!r}")
+    return in_flight - done
 
 
 def main():
-    print(f"Worker starting: {WORKER_ID}")
+    print(f"Worker starting: {WORKER_ID} batch_size={BATCH_SIZE} concurrency={CONCURRENCY}")
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="job")
+    in_flight: set[Future] = set()
+    fill_by: float | None = None
     while True:
-        job = None
         try:
-            job = claim_job()
-            if not job:
-                time.sleep(1.0)
+            in_flight = _reap(in_flight)
+            free = CONCURRENCY - len(in_flight)
+            if free == 0:
+                fill_by = None
+                wait(in_flight, return_when=FIRST_COMPLETED)
                 continue
+            if free < BATCH_SIZE:
+                # Give the rest of a batch's slots up to BATCH_WAIT to free up.
+                if fill_by is None:
+                    fill_by = time.monotonic() + BATCH_WAIT
+                remaining = fill_by - time.monotonic()
+                if remaining > 0:
+                    wait(in_flight, timeout=remaining, return_when=FIRST_COMPLETED)
+                    continue
+            fill_by = None
 
-            job_id, tenant_id, run_id, jtype, payload, attempts, max_attempts = job
-            print(f"Claimed job {job_id} type={jtype} run_id={run_id}")
-
-            if run_id:
-                mark_run_status(tenant_id, run_id, 'running')
-
-            if jtype == 'RUN_ANALYSIS':
-                run_demo_analysis(tenant_id, run_id)
-
-            if run_id:
-                mark_run_status(tenant_id, run_id, 'done')
+            # Subscribe before claiming so a job queued in between still wakes us.
+            _listener()
+            # Claim no more than we can start now, so nothing sits locked in memory.
+            jobs = claim_jobs(min(BATCH_SIZE, free))
+            if not jobs:
+                wait_for_jobs(IDLE_TIMEOUT)
+                continue
 
-            mark_job_done(job_id)
+            for job in jobs:
+                in_flight.add(executor.submit(process_job, job))
         except Exception as e:
-            err = repr(e)
-            print(f"Job error: {err}")
-            if job:
-                job_id, tenant_id, run_id, _, _, attempts, max_attempts = job
-                if run_id:
-                    mark_run_status(tenant_id, run_id, 'failed', error=err)
-                mark_job_failed(job_id, attempts, max_attempts, err)
-            else:
-                time.sleep(2.0)
+            print(f"Worker error: {e!r}")
+            time.sleep(2.0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+set -e
+cd apps/api
+exec python -m app.migrate